@@ -417,27 +417,30 @@ def write_config_file(params, output_conf_file):
     :return: config file
     :rtype: list
     """
-    with open(output_conf_file, 'w') as f:
-        for k, v in params.items():
-            if v is not None:
-                if k == 'correct':
-                    f.write(''.join(['[', k, ']' ':\t', '', '\n']))
-                    f.write(''.join(['steps = ', '\n']))
-                    for vv in v:
-                        f.write(''.join(['\t' + str(vv), '\n']))
-                elif isinstance(v, list):
-                    continue
-                else:
-                    if isinstance(v, MultiplePaths):
-                        if v.unwrapped_path is None:
-                            vv = v.converted_path
-                        else:
-                            vv = v.unwrapped_path
-                    else:
-                        vv = v
-                    f.write(''.join([k, ':\t', str(vv), '\n']))
+    lines = []
+    for k, v in params.items():
+        if v is not None:
+            if k == 'correct':
+                lines.append(''.join(['[', k, ']' ':\t', '', '\n']))
+                lines.append(''.join(['steps = ', '\n']))
+                for vv in v:
+                    lines.append(''.join(['\t' + str(vv), '\n']))
+            elif isinstance(v, list):
+                continue
             else:
-                f.write(''.join([k, ':\t', '', '\n']))
+                if isinstance(v, MultiplePaths):
+                    if v.unwrapped_path is None:
+                        vv = v.converted_path
+                    else:
+                        vv = v.unwrapped_path
+                else:
+                    vv = v
+                lines.append(''.join([k, ':\t', str(vv), '\n']))
+        else:
+            lines.append(''.join([k, ':\t', '', '\n']))
+    # format everything first and write the file in one call
+    with open(output_conf_file, 'w') as f:
+        f.write(''.join(lines))
 
 
 def parse_namelist(nml):
@@ -14,63 +14,108 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from collections import defaultdict
-from typing import List, Dict, Tuple, Any
-from nptyping import NDArray, UInt16, Float32, Shape
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Any, Optional
+from nptyping import NDArray, UInt, UInt16, Float32, Bool, Shape
 import numpy as np
+from joblib import Parallel, delayed
 
 import pyrate.constants as C
 from pyrate.core import mpiops
-from pyrate.core.phase_closure.mst_closure import sort_loops_based_on_weights_and_date, WeightedLoop, Edge
+from pyrate.core.phase_closure.mst_closure import sort_loops_based_on_weights_and_date, WeightedLoop, edge_key
 from pyrate.configuration import Configuration, MultiplePaths
 from pyrate.core.phase_closure.sum_closure import sum_phase_closures
 from pyrate.core.phase_closure.plot_closure import plot_closure
-from pyrate.core.shared import Ifg, nan_and_mm_convert
+from pyrate.core.shared import Ifg, nan_and_mm_convert, joblib_log_level
 from pyrate.core.logger import pyratelogger as log
 
+# rows of the breach count cube compared at a time, bounding the temporary boolean mask
+_BREACH_COUNT_TILE_ROWS = 512
 
-def mask_pixels_with_unwrapping_errors(ifgs_breach_count: NDArray[Shape["*, *, *"], UInt16],
+
+def _pixels_breaching_all_loops(ifgs_breach_count: NDArray[Shape["*, *, *"], UInt],
+                                num_occurrences_each_ifg: NDArray[Shape["*"], UInt16]) -> \
+        NDArray[Shape["*, *, *"], Bool]:
+    """
+    Find the pixels of each ifg that breached closure_thr in every loop the ifg participates in.
+    Evaluated for all ifgs in a single broadcast comparison over the breach count cube, or a slice of it.
+    :param ifgs_breach_count: unwrapping issues at pixels in all loops, shape=(n_ifgs, nrows, ncols)
+    :param num_occurrences_each_ifg: frequency of ifgs appearing in all loops
+    :return: boolean array of the shape of ifgs_breach_count
+    """
+    return ifgs_breach_count == num_occurrences_each_ifg[:, np.newaxis, np.newaxis]
+
+
+def mask_pixels_with_unwrapping_errors(ifgs_breach_count: NDArray[Shape["*, *, *"], UInt],
                                        num_occurrences_each_ifg: NDArray[Shape["*, *"], UInt16],
                                        params: dict) -> None:
     """
     Find pixels in the phase data that breach closure_thr, and mask
-    (assign NaNs) to those pixels in those ifgs.
-    :param ifgs_breach_count: unwrapping issues at pixels in all loops
+    (assign NaNs) to those pixels in those ifgs. Ifgs are distributed across MPI processes.
+    :param ifgs_breach_count: unwrapping issues at pixels in all loops, shape=(n_ifgs, nrows, ncols)
     :param num_occurrences_each_ifg:  frequency of ifgs appearing in all loops
     :param params: params dict
     """
     log.debug("Masking phase data of retained ifgs")
 
-    for i, m_p in enumerate(params[C.INTERFEROGRAM_FILES]):
-        pix_index = ifgs_breach_count[:, :, i] == num_occurrences_each_ifg[i]
-        ifg = Ifg(m_p.tmp_sampled_path)
-        ifg.open()
-        nan_and_mm_convert(ifg, params)
-        ifg.phase_data[pix_index] = np.nan
-        ifg.write_modified_phase()
+    process_ifgs = mpiops.array_split(list(enumerate(params[C.INTERFEROGRAM_FILES])))
+    # single broadcast comparison, over the ifgs of this process only
+    process_indices = np.array([i for i, _ in process_ifgs], dtype=np.intp)
+    pix_index = _pixels_breaching_all_loops(ifgs_breach_count[process_indices],
+                                            num_occurrences_each_ifg[process_indices])
+    # write each ifg in the background while the next one is read and masked
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending_write = None
+        for k, (_, m_p) in enumerate(process_ifgs):
+            ifg = Ifg(m_p.tmp_sampled_path)
+            ifg.open()
+            nan_and_mm_convert(ifg, params)
+            np.copyto(ifg.phase_data, np.nan, where=pix_index[k])
+            if pending_write is not None:
+                pending_write.result()  # only one masked ifg waits to be written at any time
+            pending_write = executor.submit(ifg.write_modified_phase)
+        if pending_write is not None:
+            pending_write.result()
+    mpiops.comm.barrier()
 
-    log.info(f"Masked phase data of {i + 1} retained ifgs after phase closure")
+    log.info(f"Masked phase data of {len(params[C.INTERFEROGRAM_FILES])} retained ifgs after phase closure")
     return None
 
 
-def __drop_ifgs_if_not_part_of_any_loop(ifg_files: List[str], loops: List[WeightedLoop], params: dict) -> List[str]:
+def __open_ifg(ifg_file: str, nodata_value: float) -> Ifg:
+    """Open an ifg and set its nodata value"""
+    ifg = Ifg(ifg_file)
+    ifg.open()
+    ifg.nodata_value = nodata_value
+    return ifg
+
+
+def __drop_ifgs_if_not_part_of_any_loop(ifg_files: List[str], loops: List[WeightedLoop], params: dict,
+                                        ifg_cache: Optional[Dict[str, Ifg]] = None) -> List[str]:
     """
     Check if an ifg is part of any of the loops, otherwise drop it from the list of interferograms for further PyRate
     processing.
+    :param ifg_cache: optional dict of already opened ifgs keyed by file path, reused and updated across calls.
+        Handles of ifgs no longer in `ifg_files` are closed and removed.
     """
-    loop_ifgs = set()
-    for weighted_loop in loops:
-        for edge in weighted_loop.loop:
-            loop_ifgs.add(Edge(edge.first, edge.second))
-
-    ifgs = [Ifg(i) for i in ifg_files]
-    for i in ifgs:
-        i.open()
-        i.nodata_value = params[C.NO_DATA_VALUE]
-    selected_ifg_files = []
-    for i, f in zip(ifgs, ifg_files):
-        if Edge(i.first, i.second) in loop_ifgs:
-            selected_ifg_files.append(f)
+    loop_ifgs = frozenset(edge_key(edge.first, edge.second) for weighted_loop in loops for edge in weighted_loop.loop)
+
+    if ifg_cache is None:
+        ifg_cache = {}
+    for f in set(ifg_cache).difference(ifg_files):
+        ifg_cache.pop(f).close()
+
+    unopened_files = [f for f in ifg_files if f not in ifg_cache]
+    if params[C.PARALLEL]:
+        # opening ifgs only reads metadata and is I/O bound, so threads are sufficient
+        ifgs = Parallel(n_jobs=params[C.PROCESSES], prefer='threads', verbose=joblib_log_level(C.LOG_LEVEL))(
+            delayed(__open_ifg)(f, params[C.NO_DATA_VALUE]) for f in unopened_files)
+    else:
+        ifgs = [__open_ifg(f, params[C.NO_DATA_VALUE]) for f in unopened_files]
+    ifg_cache.update(zip(unopened_files, ifgs))
+
+    ifg_edges = [edge_key(ifg_cache[f].first, ifg_cache[f].second) for f in ifg_files]
+    selected_ifg_files = [f for e, f in zip(ifg_edges, ifg_files) if e in loop_ifgs]
     if len(ifg_files) != len(selected_ifg_files):
         log.info(f'Only {len(selected_ifg_files)} (out of {len(ifg_files)}) ifgs participate in '
                  f'one or more closure loops, and are selected for further PyRate analysis')
@@ -86,32 +131,30 @@ def __drop_ifgs_exceeding_threshold(orig_ifg_files: List[str], ifgs_breach_count
     2. The second threshold is an average check of pixels breached taking all loops into account.
        It is evaluated as follows:
         (i) ifgs_breach_count contains the number of loops where this pixel in this ifg had a closure exceeding closure_thr.
-        (b) sum(ifgs_breach_count[:, :, i]) is the number of pixels in ifg exceeding closure_thr over all loops
+        (b) sum(ifgs_breach_count[i]) is the number of pixels in ifg exceeding closure_thr over all loops
         (c) divide by loop_count_of_this_ifg and num of cells (nrows x ncols) for a normalised  measure of threshold.
+    `orig_ifg_files` must be sorted, matching the ifg order of `ifgs_breach_count` and `num_occurences_each_ifg`.
     """
-    orig_ifg_files.sort()
-    nrows, ncols, n_ifgs = ifgs_breach_count.shape
-    selected_ifg_files = []
-    for i, ifg_file in enumerate(orig_ifg_files):
-        loop_count_of_this_ifg = num_occurences_each_ifg[i]
-        if loop_count_of_this_ifg:  # if the ifg participated in at least one loop
-            ifg_remove_threshold_breached = \
-                np.sum(ifgs_breach_count[:, :, i] == loop_count_of_this_ifg) / (nrows * ncols) > params[
-                    C.IFG_DROP_THR]
-
-            if not (
-                    # min loops count # check 1
-                    (num_occurences_each_ifg[i] > params[C.MIN_LOOPS_PER_IFG])
-                    and
-                    ifg_remove_threshold_breached  # and breached threshold
-            ):
-                selected_ifg_files.append(ifg_file)
+    n_ifgs, nrows, ncols = ifgs_breach_count.shape
+    # one reduction along the contiguous pixel axis of the (n_ifgs, rows * ncols) view of each row tile gives the
+    # totals of all ifgs in that tile
+    breached_pixels = np.zeros(n_ifgs, dtype=np.int64)
+    for r0 in range(0, nrows, _BREACH_COUNT_TILE_ROWS):
+        breached_pixels += np.count_nonzero(_pixels_breaching_all_loops(
+            ifgs_breach_count[:, r0:r0 + _BREACH_COUNT_TILE_ROWS], num_occurences_each_ifg
+        ).reshape(n_ifgs, -1), axis=1)
+    ifg_remove_threshold_breached = breached_pixels / (nrows * ncols) > params[C.IFG_DROP_THR]
+    min_loops_breached = num_occurences_each_ifg > params[C.MIN_LOOPS_PER_IFG]  # min loops count # check 1
+
+    # retain ifgs that participated in at least one loop, unless they breached both thresholds
+    retain = (num_occurences_each_ifg > 0) & ~(min_loops_breached & ifg_remove_threshold_breached)
+    selected_ifg_files = [ifg_file for ifg_file, r in zip(orig_ifg_files, retain) if r]
 
     return selected_ifg_files
 
 
 def iterative_closure_check(config, interactive_plot=True) -> \
-        Tuple[List[str], NDArray[Shape["*, *, *"], UInt16], NDArray[Shape["*"], UInt16]]:
+        Tuple[List[str], NDArray[Shape["*, *, *"], UInt], NDArray[Shape["*"], UInt16]]:
     """
     This function iterates the closure check until a stable list of interferogram files is returned.
     :param config: Configuration class instance
@@ -119,24 +162,30 @@ def iterative_closure_check(config, interactive_plot=True) -> \
     :return: stable list of ifg files, their ifgs_breach_count, and number of occurrences of ifgs in loops
     """
     params = config.__dict__
-    ifg_files = [ifg_path.tmp_sampled_path for ifg_path in params[C.INTERFEROGRAM_FILES]]
+    # sorted once here; each iteration only filters this list, which preserves the order
+    ifg_files = sorted(ifg_path.tmp_sampled_path for ifg_path in params[C.INTERFEROGRAM_FILES])
     i = 1  # iteration counter
-
-    while True:  # iterate till ifgs/loops are stable
-        log.info(f"Closure check iteration #{i}: working on {len(ifg_files)} ifgs")
-        rets = __wrap_closure_check(config)
-        if rets is None:
-            return
-        new_ifg_files, closure, ifgs_breach_count, num_occurences_each_ifg, loops = rets
-        if interactive_plot:
-            if mpiops.rank == 0:
-                plot_closure(closure=closure, loops=loops, config=config,
-                             thr=params[C.CLOSURE_THR], iteration=i)
-        if len(ifg_files) == len(new_ifg_files):
-            break
-        else:
-            i += 1
-            ifg_files = new_ifg_files  # exit condition could be some other check like number_of_loops
+    ifg_cache: Dict[str, Ifg] = {}  # ifgs opened in one iteration are reused in the next
+
+    try:
+        while True:  # iterate till ifgs/loops are stable
+            log.info(f"Closure check iteration #{i}: working on {len(ifg_files)} ifgs")
+            rets = __wrap_closure_check(config, ifg_files, ifg_cache)
+            if rets is None:
+                return
+            new_ifg_files, closure, ifgs_breach_count, num_occurences_each_ifg, loops = rets
+            if interactive_plot:
+                if mpiops.rank == 0:
+                    plot_closure(closure=closure, loops=loops, config=config,
+                                 thr=params[C.CLOSURE_THR], iteration=i)
+            if len(ifg_files) == len(new_ifg_files):
+                break
+            else:
+                i += 1
+                ifg_files = new_ifg_files  # exit condition could be some other check like number_of_loops
+    finally:
+        for ifg in ifg_cache.values():
+            ifg.close()
 
     mpiops.comm.barrier()
 
@@ -153,35 +202,43 @@ def discard_loops_containing_max_ifg_count(loops: List[WeightedLoop], params) ->
     :return: selected loops satisfying MAX_LOOP_REDUNDANCY criteria
     """
     selected_loops = []
-    ifg_counter = defaultdict(int)
-    for loop in loops:
-        edge_appearances = np.array([ifg_counter[e] for e in loop.edges])
-        if not np.all(edge_appearances > params[C.MAX_LOOP_REDUNDANCY]):
+    max_loop_redundancy = params[C.MAX_LOOP_REDUNDANCY]
+
+    # map the edges of all loops to dense integer ids once, so that edge counts live in a contiguous array
+    edge_ids = {}
+    loops_edge_ids = [
+        np.fromiter((edge_ids.setdefault(edge_key(swe.first, swe.second), len(edge_ids)) for swe in loop.loop),
+                    dtype=np.int32, count=len(loop))
+        for loop in loops
+    ]
+    ifg_counter = np.zeros(len(edge_ids), dtype=np.int32)
+
+    for loop, loop_edge_ids in zip(loops, loops_edge_ids):
+        if not np.all(ifg_counter[loop_edge_ids] > max_loop_redundancy):
             selected_loops.append(loop)
-            for e in loop.edges:
-                ifg_counter[e] += 1
+            ifg_counter[loop_edge_ids] += 1  # edges within a closed loop are distinct
         else:
             log.debug(f"Loop {loop.loop} ignored: all constituent ifgs have been in a loop "
                       f"{params[C.MAX_LOOP_REDUNDANCY]} times or more")
     return selected_loops
 
 
-def __wrap_closure_check(config: Configuration) -> \
+def __wrap_closure_check(config: Configuration, ifg_files: List[str], ifg_cache: Optional[Dict[str, Ifg]] = None) -> \
         Tuple[
             List[str],
             NDArray[Shape["*, *"], Float32],
-            NDArray[Shape["*, *, *"], UInt16],
+            NDArray[Shape["*, *, *"], UInt],
             NDArray[Shape["*"], UInt16],
             List[WeightedLoop]]:
     """
     This wrapper function returns the closure check outputs for a single iteration of closure check.
 
     :param config: Configuration class instance
+    :param ifg_files: sorted list of ifg files taking part in this iteration
+    :param ifg_cache: optional dict of opened ifgs keyed by file path, reused across closure check iterations
     For return variables see docstring in `sum_phase_closures`.
     """
     params = config.__dict__
-    ifg_files = [ifg_path.tmp_sampled_path for ifg_path in params[C.INTERFEROGRAM_FILES]]
-    ifg_files.sort()
     log.debug(f"The number of ifgs in the list is {len(ifg_files)}")
     sorted_signed_loops = mpiops.run_once(sort_loops_based_on_weights_and_date, params)
     log.info(f"Total number of selected closed loops with up to MAX_LOOP_LENGTH = "
@@ -192,7 +249,8 @@ def __wrap_closure_check(config: Configuration) -> \
 
     retained_loops = mpiops.run_once(discard_loops_containing_max_ifg_count,
                                      sorted_signed_loops, params)
-    ifgs_with_loops = mpiops.run_once(__drop_ifgs_if_not_part_of_any_loop, ifg_files, retained_loops, params)
+    ifgs_with_loops = mpiops.run_once(__drop_ifgs_if_not_part_of_any_loop, ifg_files, retained_loops, params,
+                                      ifg_cache)
 
     msg = f"After applying MAX_LOOP_REDUNDANCY = {params[C.MAX_LOOP_REDUNDANCY]} criteria, " \
           f"{len(retained_loops)} loops are retained"
@@ -28,6 +28,16 @@ from pyrate.core.logger import pyratelogger as log
 Edge = namedtuple('Edge', ['first', 'second'])
 
 
+def edge_key(first: date, second: date) -> int:
+    """
+    Pack the first and second dates of an edge into a single integer, for cheap hashing in sets and dicts.
+    :param first: first date of the edge
+    :param second: second date of the edge
+    :return: integer key unique to the edge
+    """
+    return (first.toordinal() << 32) | second.toordinal()
+
+
 class SignedEdge:
 
     def __init__(self, edge: Edge, sign: int):
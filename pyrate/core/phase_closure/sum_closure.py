@@ -17,7 +17,7 @@
 import resource
 from collections import namedtuple
 from typing import List, Dict, Tuple, Any
-from nptyping import NDArray, Float32, UInt16, Shape
+from nptyping import NDArray, Float32, UInt, UInt16, Shape
 import numpy as np
 
 import pyrate.constants as C
@@ -62,7 +62,7 @@ def __create_ifg_edge_dict(ifg_files: List[str], params: dict) -> Dict[Edge, Ind
 
 
 def sum_phase_closures(ifg_files: List[str], loops: List[WeightedLoop], params: dict) -> \
-        Tuple[NDArray[Shape["*, *, *"], Float32], NDArray[Shape["*, *, *"], UInt16], NDArray[Shape["*"], UInt16]]:
+        Tuple[NDArray[Shape["*, *, *"], Float32], NDArray[Shape["*, *, *"], UInt], NDArray[Shape["*"], UInt16]]:
     """
     Compute the closure sum for each pixel in each loop, and count the number of times a pixel
     contributes to a failed closure loop (where the summed closure is above/below the 
@@ -72,13 +72,16 @@ def sum_phase_closures(ifg_files: List[str], loops: List[WeightedLoop], params:
     :param params: params dict
     :return: Tuple of closure, ifgs_breach_count, num_occurrences_each_ifg
     closure: summed closure for each loop.
-    ifgs_breach_count: shape=(ifg.shape, n_ifgs) number of times a pixel in an ifg fails the closure
-    check (i.e., has unwrapping error) in all loops under investigation.
+    ifgs_breach_count: shape=(n_ifgs, ifg.shape) number of times a pixel in an ifg fails the closure
+    check (i.e., has unwrapping error) in all loops under investigation. Stored as uint8 when there are
+    at most 255 loops, otherwise uint16. Available on all MPI processes.
     num_occurrences_each_ifg: frequency of ifg appearance in all loops.
     """
     edge_to_indexed_ifgs = __create_ifg_edge_dict(ifg_files, params)
     ifgs = [v.IfgPhase for v in edge_to_indexed_ifgs.values()]
     n_ifgs = len(ifgs)
+    # a pixel of an ifg can breach at most once per loop, so the count is bounded by the number of loops
+    breach_count_dtype = np.uint8 if len(loops) <= np.iinfo(np.uint8).max else np.uint16
 
     if params[C.PARALLEL]:
         # rets = Parallel(n_jobs=params[cf.PROCESSES], verbose=joblib_log_level(cf.LOG_LEVEL))(
@@ -89,19 +92,17 @@ def sum_phase_closures(ifg_files: List[str], loops: List[WeightedLoop], params:
         #     closure_dict[k], ifgs_breach_count_dict[k] = r
         # TODO: enable multiprocessing - needs pickle error workaround
         closure = np.zeros(shape=(* ifgs[0].phase_data.shape, len(loops)), dtype=np.float32)
-        ifgs_breach_count = np.zeros(shape=(ifgs[0].phase_data.shape + (n_ifgs,)), dtype=np.uint16)
+        ifgs_breach_count = np.zeros(shape=((n_ifgs,) + ifgs[0].phase_data.shape), dtype=breach_count_dtype)
         for k, weighted_loop in enumerate(loops):
-            closure[:, :, k], ifgs_breach_count_l = __compute_ifgs_breach_count(weighted_loop, edge_to_indexed_ifgs,
-                                                                                params)
-            ifgs_breach_count += ifgs_breach_count_l
+            closure[:, :, k] = __compute_ifgs_breach_count(weighted_loop, edge_to_indexed_ifgs, params,
+                                                           ifgs_breach_count)
     else:
         process_loops = mpiops.array_split(loops)
         closure_process = np.zeros(shape=(* ifgs[0].phase_data.shape, len(process_loops)), dtype=np.float32)
-        ifgs_breach_count_process = np.zeros(shape=(ifgs[0].phase_data.shape + (n_ifgs,)), dtype=np.uint16)
+        ifgs_breach_count_process = np.zeros(shape=((n_ifgs,) + ifgs[0].phase_data.shape), dtype=breach_count_dtype)
         for k, weighted_loop in enumerate(process_loops):
-            closure_process[:, :, k], ifgs_breach_count_l = \
-                __compute_ifgs_breach_count(weighted_loop, edge_to_indexed_ifgs, params)
-            ifgs_breach_count_process += ifgs_breach_count_l  # process
+            closure_process[:, :, k] = __compute_ifgs_breach_count(weighted_loop, edge_to_indexed_ifgs, params,
+                                                                   ifgs_breach_count_process)
 
         total_gb = mpiops.comm.allreduce(ifgs_breach_count_process.nbytes / 1e9, op=mpiops.MPI.SUM)
         log.debug(f"Memory usage to compute ifgs_breach_count_process was {total_gb} GB")
@@ -111,8 +112,6 @@ def sum_phase_closures(ifg_files: List[str], loops: List[WeightedLoop], params:
         total_gb = mpiops.comm.allreduce(closure_process.nbytes / 1e9, op=mpiops.MPI.SUM)
         log.debug(f"Memory usage to compute closure_process was {total_gb} GB")
         if mpiops.rank == 0:
-            ifgs_breach_count = np.zeros(shape=(ifgs[0].phase_data.shape + (n_ifgs,)), dtype=np.uint16)
-
             # closure
             closure = np.zeros(shape=(* ifgs[0].phase_data.shape, len(loops)), dtype=np.float32)
             main_process_indices = mpiops.array_split(range(len(loops))).astype(np.uint16)
@@ -124,20 +123,20 @@ def sum_phase_closures(ifg_files: List[str], loops: List[WeightedLoop], params:
                 closure[:, :, rank_indices] = this_rank_closure
         else:
             closure = None
-            ifgs_breach_count = None
             mpiops.comm.Send(closure_process, dest=0, tag=mpiops.rank)
 
+        # sum the breach counts of all processes, and make the global count available to every process
         if mpiops.MPI_INSTALLED:
-            mpiops.comm.Reduce([ifgs_breach_count_process, mpiops.MPI.UINT16_T],
-                               [ifgs_breach_count, mpiops.MPI.UINT16_T], op=mpiops.MPI.SUM, root=0)  # global
-        else:
-            ifgs_breach_count = mpiops.comm.reduce(ifgs_breach_count_process, op=mpiops.sum0_op, root=0)
+            mpi_dtype = mpiops.MPI.UINT8_T if breach_count_dtype == np.uint8 else mpiops.MPI.UINT16_T
+            mpiops.comm.Allreduce(mpiops.MPI.IN_PLACE, [ifgs_breach_count_process, mpi_dtype],
+                                  op=mpiops.MPI.SUM)  # global
+            ifgs_breach_count = ifgs_breach_count_process
+        else:  # single process already holds the global count; reducing would upcast it to uint64
+            ifgs_breach_count = ifgs_breach_count_process
 
         log.debug(f"successfully summed phase closure breach array")
 
-    num_occurrences_each_ifg = None
-    if mpiops.rank == 0:
-        num_occurrences_each_ifg = _find_num_occurrences_each_ifg(loops, edge_to_indexed_ifgs, n_ifgs)
+    num_occurrences_each_ifg = _find_num_occurrences_each_ifg(loops, edge_to_indexed_ifgs, n_ifgs)
 
     return closure, ifgs_breach_count, num_occurrences_each_ifg
 
@@ -156,23 +155,26 @@ def _find_num_occurrences_each_ifg(loops: List[WeightedLoop],
 
 
 def __compute_ifgs_breach_count(weighted_loop: WeightedLoop,
-                                edge_to_indexed_ifgs: Dict[Edge, IndexedIfg], params: dict) \
-        -> Tuple[NDArray[Shape["*, *"], Float32], NDArray[Shape["*, *, *"], UInt16]]:
-    """Compute summed `closure` of each loop, and compute `ifgs_breach_count` for each pixel."""
-    n_ifgs = len(edge_to_indexed_ifgs)
-    indexed_ifg = list(edge_to_indexed_ifgs.values())[0]
-    ifg = indexed_ifg.IfgPhase
+                                edge_to_indexed_ifgs: Dict[Edge, IndexedIfg], params: dict,
+                                ifgs_breach_count: NDArray[Shape["*, *, *"], UInt]) \
+        -> NDArray[Shape["*, *"], Float32]:
+    """
+    Compute summed `closure` of each loop, and increment `ifgs_breach_count` in place for each pixel
+    breaching the closure threshold. Accumulating into the caller's array avoids allocating and adding
+    a full (n_ifgs, nrows, ncols) array for every loop.
+    """
     closure_thr = params[C.CLOSURE_THR] * np.pi
     use_median = params[C.SUBTRACT_MEDIAN]
 
-    closure = np.zeros(shape=ifg.phase_data.shape, dtype=np.float32)
-    # initiate variable for check of unwrapping issues at the same pixels in all loops
-    ifgs_breach_count = np.zeros(shape=(ifg.phase_data.shape + (n_ifgs,)), dtype=np.uint16)
-
+    closure = np.zeros(shape=ifgs_breach_count.shape[1:], dtype=np.float32)
     for signed_edge in weighted_loop.loop:
         indexed_ifg = edge_to_indexed_ifgs[signed_edge.edge]
         ifg = indexed_ifg.IfgPhase
-        closure += signed_edge.sign * ifg.phase_data
+        # add or subtract in place, rather than allocating the signed phase of each ifg
+        if signed_edge.sign > 0:
+            closure += ifg.phase_data
+        else:
+            closure -= ifg.phase_data
     if use_median:
         closure -= np.nanmedian(closure)  # optionally subtract the median closure phase
 
@@ -185,5 +187,5 @@ def __compute_ifgs_breach_count(weighted_loop: WeightedLoop,
         # make sure we are not incrementing the nan positions in the closure
         # as we don't know the phase of these pixels and also they were converted to zero before closure check
         # Therefore, we leave them out of ifgs_breach_count, i.e., we don't increment their ifgs_breach_count values
-        ifgs_breach_count[indices_breaching_threshold, ifg_index] += 1
-    return closure, ifgs_breach_count
+        ifgs_breach_count[ifg_index, indices_breaching_threshold] += 1
+    return closure
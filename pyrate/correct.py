@@ -182,8 +182,7 @@ def phase_closure_wrapper(params: dict, config: Configuration) -> dict:
             f.writelines(lines)
 
     # mask ifgs with nans where phase unwrap threshold is breached
-    if mpiops.rank == 0:
-        mask_pixels_with_unwrapping_errors(ifgs_breach_count, num_occurences_each_ifg, params)
+    mask_pixels_with_unwrapping_errors(ifgs_breach_count, num_occurences_each_ifg, params)
 
     _create_ifg_dict(params) # update the preread_ifgs dict
 
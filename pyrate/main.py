@@ -33,6 +33,8 @@ from pyrate.core.shared import mpi_vs_multiprocess_logging
 from pyrate.core.stack import stack_calc_wrapper
 from pyrate.core.timeseries import timeseries_calc_wrapper
 
+WORKFLOW_STAGES = ['conv2tif', 'prepifg', 'correct', 'timeseries', 'stack', 'merge']
+
 
 def _params_from_conf(config_file):
     config_file = os.path.abspath(config_file)
@@ -89,6 +91,9 @@ def main():
     for p in [parser_conv2tif, parser_prepifg, parser_correct, parser_merge, parser_ts, parser_stack, parser_workflow]:
         p.add_argument('-f', '--config_file', action="store", type=str, default=None,
                        help="Pass configuration file", required=False)
+    parser_workflow.add_argument('-s', '--stages', nargs='+', choices=WORKFLOW_STAGES, default=WORKFLOW_STAGES,
+                                 metavar='STAGE', help="<Optional> Only run these processing steps, in workflow "
+                                                       "order, as a single job. Default: all steps.")
 
     args = parser.parse_args()
 
@@ -129,30 +134,37 @@ def main():
         merge.main(params)
 
     if args.command == "workflow":
-        log.info("***********CONV2TIF**************")
-        conv2tif.main(params)
-
-        log.info("***********PREPIFG**************")
-        params = mpiops.run_once(_params_from_conf, args.config_file)
-        prepifg.main(params)
-
-        log.info("***********CORRECT**************")
-        # reset params as prepifg modifies params
+        stages = set(args.stages)
         config_file = os.path.abspath(args.config_file)
-        config = Configuration(config_file)
-        correct.main(config)
-
-        log.info("***********TIMESERIES**************")
-        config = Configuration(config_file)
-        timeseries(config)
-
-        log.info("***********STACK**************")
-        config = Configuration(config_file)
-        stack(config)
-
-        log.info("***********MERGE**************")
-        params = mpiops.run_once(_params_from_conf, args.config_file)
-        merge.main(params)
+        if "conv2tif" in stages:
+            log.info("***********CONV2TIF**************")
+            conv2tif.main(params)
+
+        if "prepifg" in stages:
+            log.info("***********PREPIFG**************")
+            params = mpiops.run_once(_params_from_conf, args.config_file)
+            prepifg.main(params)
+
+        if "correct" in stages:
+            log.info("***********CORRECT**************")
+            # reset params as prepifg modifies params
+            config = Configuration(config_file)
+            correct.main(config)
+
+        if "timeseries" in stages:
+            log.info("***********TIMESERIES**************")
+            config = Configuration(config_file)
+            timeseries(config)
+
+        if "stack" in stages:
+            log.info("***********STACK**************")
+            config = Configuration(config_file)
+            stack(config)
+
+        if "merge" in stages:
+            log.info("***********MERGE**************")
+            params = mpiops.run_once(_params_from_conf, args.config_file)
+            merge.main(params)
 
     log.info("--- Runtime = %s seconds ---" % (time.time() - start_time))
 
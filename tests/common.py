@@ -18,12 +18,14 @@ This Python module contains generic utilities and mock objects for use in the
 PyRate test suite.
 """
 
+import fnmatch
 import glob
+import hashlib
 import os
 import shutil
 import stat
-import itertools
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 import pytest
 from typing import Iterable, Union
@@ -60,6 +62,23 @@ PY37GDAL304 = PYTHON3P7 and (GDAL_VERSION == '3.0.4')
 
 
 TEMPDIR = tempfile.gettempdir()
+
+
+def __ram_tempdir(min_free_bytes=4 * 2 ** 30):
+    """
+    /dev/shm if opted in with PYRATE_TEST_TMPFS=1, and it is available and has room for a full pipeline run,
+    otherwise None. Opt-in only, as temp dirs left behind by tests hold on to RAM until the next reboot.
+    """
+    if os.environ.get('PYRATE_TEST_TMPFS') != '1':
+        return None
+    shm = Path('/dev/shm')
+    if shm.is_dir() and os.access(shm, os.W_OK) and shutil.disk_usage(shm).free >= min_free_bytes:
+        return shm.as_posix()
+    return None
+
+
+# tmpfs backed parent directory of per test temp dirs, None means the system default
+RAM_TEMPDIR = __ram_tempdir()
 TESTDIR = join(PYRATEPATH, 'tests')
 BASE_TEST = join(PYRATEPATH, "tests", "test_data")
 SML_TEST_DIR = join(BASE_TEST, "small_test")
@@ -554,13 +573,45 @@ def pre_prepare_ifgs(ifg_paths, params):
     return ifgs
 
 
-def assert_two_dirs_equal(dir1, dir2, ext, num_files=None):
-    if not isinstance(ext, list):
-        ext = [ext]
-    dir1_files = list(itertools.chain(* [list(Path(dir1).glob(ex)) for ex in ext]))
-    dir2_files = list(itertools.chain(* [list(Path(dir2).glob(ex)) for ex in ext]))
-    dir1_files.sort()
-    dir2_files.sort()
+class DirIndex(dict):
+    """
+    Names of the files in each directory, listed on first use. Create one per test after all outputs are written,
+    and pass it to the assert helpers below, so that each directory is listed once however many patterns are checked.
+    """
+
+    def __missing__(self, directory):
+        names = self[directory] = [entry.name for entry in os.scandir(directory)]
+        return names
+
+    def matching_files(self, directory, ext):
+        """Sorted files in `directory` matching any of the glob patterns in `ext`"""
+        directory = Path(directory)
+        return sorted(directory.joinpath(name) for ex in ext for name in fnmatch.filter(self[directory], ex))
+
+
+def __file_digest(path, block_size=1 << 20):
+    """blake2b digest of the file contents"""
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        advise = hasattr(os, 'posix_fadvise')  # not available on Windows and macOS
+        if advise:  # read ahead aggressively
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+        if advise:  # hashed files are rarely read again, do not let them evict other pages from the cache
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return digest.digest()
+
+
+def __file_digests(*file_lists):
+    """Digests of the tif and npy files in all lists, hashed as one batch of parallel threads"""
+    files = [f for file_list in file_lists for f in file_list if f.suffix in {'.tif', '.npy'}]
+    # hashlib releases the GIL while hashing, so threads overlap the reading and hashing of files
+    with ThreadPoolExecutor() as executor:
+        return dict(zip(files, executor.map(__file_digest, files)))
+
+
+def __assert_files_equal(dir1_files, dir2_files, digests, num_files=None):
     # 17 unwrapped geotifs
     # 17 cropped multilooked tifs + 1 dem
     if num_files is not None:
@@ -568,24 +619,40 @@ def assert_two_dirs_equal(dir1, dir2, ext, num_files=None):
         assert len(dir2_files) == num_files
     else:
         assert len(dir1_files) == len(dir2_files)
-    if dir1_files[0].suffix == '.tif':
-        for m_f, s_f in zip(dir1_files, dir2_files):
-            assert m_f.name == s_f.name
-            assert_tifs_equal(m_f.as_posix(), s_f.as_posix())
-
-    elif dir1_files[0].suffix == '.npy':
+    if dir1_files[0].suffix in {'.tif', '.npy'}:
         for m_f, s_f in zip(dir1_files, dir2_files):
             assert m_f.name == s_f.name
-            np.testing.assert_array_almost_equal(np.load(m_f), np.load(s_f), decimal=3)
+            if digests[m_f] == digests[s_f]:  # identical bytes, no need to decode the rasters or load the arrays
+                continue
+            if m_f.suffix == '.tif':
+                assert_tifs_equal(m_f.as_posix(), s_f.as_posix())
+            else:
+                np.testing.assert_array_almost_equal(np.load(m_f), np.load(s_f), decimal=3)
     elif dir1_files[0].suffix in {'.kml', '.png'}:
         return
     else:
         raise
 
 
-def assert_same_files_produced(dir1, dir2, dir3, ext, num_files=None):
-    assert_two_dirs_equal(dir1, dir2, ext, num_files)
-    assert_two_dirs_equal(dir1, dir3, ext, num_files)
+def assert_two_dirs_equal(dir1, dir2, ext, num_files=None, index=None):
+    if not isinstance(ext, list):
+        ext = [ext]
+    if index is None:
+        index = DirIndex()
+    dir1_files, dir2_files = index.matching_files(dir1, ext), index.matching_files(dir2, ext)
+    __assert_files_equal(dir1_files, dir2_files, __file_digests(dir1_files, dir2_files), num_files)
+
+
+def assert_same_files_produced(dir1, dir2, dir3, ext, num_files=None, index=None):
+    if not isinstance(ext, list):
+        ext = [ext]
+    if index is None:
+        index = DirIndex()
+    dir1_files, dir2_files, dir3_files = [index.matching_files(d, ext) for d in (dir1, dir2, dir3)]
+    # the files of dir1 are hashed once for both comparisons
+    digests = __file_digests(dir1_files, dir2_files, dir3_files)
+    __assert_files_equal(dir1_files, dir2_files, digests, num_files)
+    __assert_files_equal(dir1_files, dir3_files, digests, num_files)
 
 
 working_dirs = {
@@ -597,8 +664,10 @@ working_dirs = {
 }
 
 
-def manipulate_test_conf(conf_file, work_dir: Path):
-    params = Configuration(conf_file).__dict__
+def manipulate_test_conf(conf_file, work_dir: Path, params: dict = None):
+    """params: optional, already parsed and modifiable params of conf_file"""
+    if params is None:
+        params = Configuration(conf_file).__dict__
     if conf_file == MEXICO_CROPA_CONF:
         copytree(MEXICO_CROPA_DIR, work_dir)
         copytree(MEXICO_CROPA_DIR_HEADERS, work_dir)
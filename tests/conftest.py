@@ -27,7 +27,7 @@ from pyrate.constants import PYRATEPATH
 from pyrate.core import mpiops, shared
 from pyrate.configuration import Configuration
 from tests.common import TEST_CONF_ROIPAC, TEST_CONF_GAMMA, SML_TEST_DEM_TIF, MEXICO_CROPA_CONF
-from tests.common import ROIPAC_SYSTEM_CONF, GAMMA_SYSTEM_CONF, GEOTIF_SYSTEM_CONF, SML_TEST_COH_LIST
+from tests.common import ROIPAC_SYSTEM_CONF, GAMMA_SYSTEM_CONF, GEOTIF_SYSTEM_CONF, SML_TEST_COH_LIST, RAM_TEMPDIR
 
 
 @pytest.fixture
@@ -36,7 +36,8 @@ def tempdir():
     tempdir for tests
     """
     def tmpdir():
-        return tempfile.mkdtemp()
+        # on tmpfs when opted in with PYRATE_TEST_TMPFS=1, as pipeline runs write many tiles and tifs
+        return tempfile.mkdtemp(dir=RAM_TEMPDIR)
     return tmpdir
 
 
@@ -15,15 +15,20 @@
 #   limitations under the License.
 
 
+from datetime import date
+
 import numpy as np
+import pytest
 
 import pyrate.constants as C
+from pyrate.core.phase_closure import closure_check
 from pyrate.core.phase_closure.mst_closure import (
-    sort_loops_based_on_weights_and_date,
+    sort_loops_based_on_weights_and_date, Edge, SignedEdge, SignedWeightedEdge, WeightedLoop
 )
 from pyrate.core.phase_closure.closure_check import (
     discard_loops_containing_max_ifg_count,
-    __drop_ifgs_if_not_part_of_any_loop
+    __drop_ifgs_if_not_part_of_any_loop,
+    __drop_ifgs_exceeding_threshold
 )
 
 
@@ -55,11 +60,53 @@ def retain_loops(params):
 def test_drop_ifgs_if_not_part_of_any_loop(closure_params):
     params = closure_params
     params[C.NO_DATA_VALUE] = 0.0
+    params[C.PROCESSES] = 2
     geotiffs = params['geotiffs']
 
     loops1 = retain_loops(params)
+    params[C.PARALLEL] = 0
     selected_tifs1 = __drop_ifgs_if_not_part_of_any_loop(geotiffs, loops1, params)
 
     loops2 = retain_loops(params)
+    params[C.PARALLEL] = 1
     selected_tifs2 = __drop_ifgs_if_not_part_of_any_loop(geotiffs, loops2, params)
     assert all([a == b for a, b in zip(selected_tifs1, selected_tifs2)])
+
+
+@pytest.mark.parametrize('tile_rows', [1, 512])
+def test_drop_ifgs_exceeding_threshold(monkeypatch, tile_rows):
+    monkeypatch.setattr(closure_check, '_BREACH_COUNT_TILE_ROWS', tile_rows)
+    params = {C.MIN_LOOPS_PER_IFG: 2, C.IFG_DROP_THR: 0.2}
+    ifg_files = ['f0', 'f1', 'f2', 'f3', 'f4', 'f5']
+    num_occurrences_each_ifg = np.array([0, 2, 3, 3, 3, 1], dtype=np.uint16)
+    ifgs_breach_count = np.zeros(shape=(6, 2, 5), dtype=np.uint8)  # 10 pixels per ifg
+    # f0: in no loop, dropped although its (zero) breach count matches its loop count everywhere
+    ifgs_breach_count[1] = 2  # f1: all pixels breach, but f1 is not in more than MIN_LOOPS_PER_IFG loops
+    ifgs_breach_count[2, 0, :3] = 3  # f2: 3/10 pixels breach in all loops, above IFG_DROP_THR
+    ifgs_breach_count[3, 1, :2] = 3  # f3: 2/10 pixels breach in all loops, not above IFG_DROP_THR
+    ifgs_breach_count[4] = 2  # f4: all pixels breach, but not in all 3 loops
+    # f5: no breaches
+    selected = __drop_ifgs_exceeding_threshold(ifg_files, ifgs_breach_count, num_occurrences_each_ifg, params)
+    assert selected == ['f1', 'f3', 'f4', 'f5']
+
+
+def _weighted_loop(*edges):
+    return WeightedLoop([SignedWeightedEdge(SignedEdge(e, 1), (e.second - e.first).days) for e in edges])
+
+
+def test_discard_loops_containing_max_ifg_count_selects_loops_with_an_underused_ifg():
+    d0, d1, d2, d3 = date(2020, 1, 1), date(2020, 1, 13), date(2020, 1, 25), date(2020, 2, 6)
+    e01, e12, e02, e23, e13, e03 = Edge(d0, d1), Edge(d1, d2), Edge(d0, d2), Edge(d2, d3), Edge(d1, d3), \
+        Edge(d0, d3)
+    loops = [
+        _weighted_loop(e01, e12, e02),  # 0: all ifgs unused, selected
+        _weighted_loop(e01, e12, e02),  # 1: all ifgs used once, i.e. not above MAX_LOOP_REDUNDANCY, selected
+        _weighted_loop(e01, e12, e02),  # 2: all ifgs used twice, discarded
+        _weighted_loop(e12, e23, e13),  # 3: e23 and e13 unused, selected
+        _weighted_loop(e02, e23, e03),  # 4: e23 used once and e03 unused, selected
+        _weighted_loop(e12, e23, e13),  # 5: e13 used once, selected
+        _weighted_loop(e12, e23, e13),  # 6: all ifgs used at least twice, discarded
+    ]
+    params = {C.MAX_LOOP_REDUNDANCY: 1}
+    selected = discard_loops_containing_max_ifg_count(loops, params)
+    assert [id(l) for l in selected] == [id(loops[i]) for i in (0, 1, 3, 4, 5)]
@@ -22,7 +22,7 @@ from pyrate.constants import PYRATEPATH
 from pyrate.core.phase_closure.mst_closure import (
     __find_closed_loops, Edge, SignedWeightedEdge, SignedEdge, __setup_edges,
     __add_signs_and_weights_to_loops, sort_loops_based_on_weights_and_date, WeightedLoop,
-    __find_signed_closed_loops
+    __find_signed_closed_loops, edge_key
 )
 import pyrate.constants as C
 from tests.phase_closure.common import IfgDummy
@@ -139,3 +139,10 @@ def test_sort_loops_based_on_weights_and_date_2(closure_params):
     sorted_loops1 = sort_loops_based_on_weights_and_date(closure_params)
     sorted_loops2 = sort_loops_based_on_weights_and_date(closure_params)
     compare_loops(sorted_loops1, sorted_loops2)
+
+
+def test_edge_key():
+    d1, d2, d3 = date(2006, 8, 28), date(2006, 10, 2), date(2007, 1, 15)
+    assert edge_key(d1, d2) == edge_key(*Edge(d1, d2))
+    keys = {edge_key(d1, d2), edge_key(d2, d1), edge_key(d1, d3), edge_key(d2, d3)}
+    assert len(keys) == 4
@@ -17,18 +17,25 @@
 This Python module contains regression tests for comparing output from serial,
 parallel and MPI PyRate runs.
 """
+import filecmp
+import os
 import shutil
+import zlib
 import pytest
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from pathlib import Path
 from subprocess import check_call, CalledProcessError, run
 import numpy as np
 
 import pyrate.constants as C
 from pyrate.configuration import Configuration, write_config_file
+from pyrate.core.phase_closure.mst_closure import edge_key
 
 from tests.common import (
     assert_same_files_produced,
     assert_two_dirs_equal,
+    DirIndex,
     manipulate_test_conf,
     MEXICO_CROPA_CONF,
     TEST_CONF_GAMMA,
@@ -36,31 +43,71 @@ from tests.common import (
     PY37GDAL302,
     PYTHON3P8,
     PYTHON3P7,
-    WORKING_DIR
+    WORKING_DIR,
+    RAM_TEMPDIR
 )
 
 
+def _skip_unless_sampled(request, percent):
+    """
+    Skip all but `percent` % of the parametrisations of a test. The selection is deterministic, based on the
+    test id, so that a CI run is reproducible. The PYRATE_TEST_SAMPLE environment variable overrides `percent`.
+    """
+    percent = int(os.environ.get("PYRATE_TEST_SAMPLE", percent))
+    if zlib.crc32(request.node.nodeid.encode()) % 100 >= percent:
+        pytest.skip(f"Skipping as only {percent} percent of tests are sampled")
+
+
+# The params of the fixtures below are listed in order of decreasing runtime, so that the longest tests are
+# collected, and with pytest-xdist (e.g. --dist=worksteal) dispatched, first and short tests fill up idle workers.
 @pytest.fixture(params=[0, 1])
 def parallel(request):
+    """serial workflow (0) takes longer than the multiprocess one (1)"""
     return request.param
 
 
-@pytest.fixture(params=[1, 4])
+@pytest.fixture(params=[4, 1])
 def local_crop(request):
+    """uncropped ifgs (4) are larger than the minimum crop (1)"""
     return request.param
 
 
+def _parsed_conf_copy(parsed_confs, conf_file):
+    """
+    Copy of the params of conf_file, which is parsed only once per test. Every pipeline of a test gets its own
+    copy, which manipulate_test_conf points at the pipeline's working dir.
+    """
+    if conf_file not in parsed_confs:
+        parsed_confs[conf_file] = Configuration(conf_file).__dict__
+    return deepcopy(parsed_confs[conf_file])
+
+
+@pytest.fixture(scope='module')
+def deferred_rmtree():
+    """
+    Removes the working dirs of finished tests in the background, while the next test runs.
+    All removals are completed at the end of the module, and a failed removal fails the teardown.
+    """
+    futures = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield lambda path: futures.append(executor.submit(shutil.rmtree, path))
+        for future in futures:
+            future.result()
+
+
 @pytest.fixture()
 def modified_config(tempdir, get_lks, get_crop, orbfit_lks, orbfit_method, orbfit_degrees, ref_est_method):
-    def modify_params(conf_file, parallel_vs_serial, output_conf_file):
+    parsed_confs = {}
+
+    def modify_params(conf_file, parallel_vs_serial, output_conf_file, processes=4):
         tdir = Path(tempdir())
-        params = manipulate_test_conf(conf_file, tdir)
+        params = manipulate_test_conf(conf_file, tdir, _parsed_conf_copy(parsed_confs, conf_file))
 
         if params[C.PROCESSOR] == 1:  # turn on coherence for gamma
             params[C.COH_MASK] = 1
 
         params[C.PARALLEL] = parallel_vs_serial
-        params[C.PROCESSES] = 4
+        params[C.PROCESSES] = processes
         params[C.APSEST] = 1
         params[C.IFG_LKSX], params[C.IFG_LKSY] = get_lks, get_lks
         params[C.REFNX], params[C.REFNY] = 2, 2
@@ -89,52 +136,43 @@ def modified_config(tempdir, get_lks, get_crop, orbfit_lks, orbfit_method, orbfi
 @pytest.mark.mpi
 @pytest.mark.slow
 @pytest.mark.skipif(not PYTHON3P8, reason="Only run in one CI env")
-def test_pipeline_parallel_vs_mpi(modified_config, gamma_or_mexicoa_conf=TEST_CONF_GAMMA):
+def test_pipeline_parallel_vs_mpi(request, modified_config, deferred_rmtree, gamma_or_mexicoa_conf=TEST_CONF_GAMMA):
     """
     Tests proving single/multiprocess/mpi produce same output
     """
     gamma_conf = gamma_or_mexicoa_conf
-    if np.random.rand() > 0.1:  # skip 90% of tests randomly
-        pytest.skip("Randomly skipping as part of 85 percent")
-        if gamma_conf == MEXICO_CROPA_CONF:  # skip cropA conf 95% time
-            if np.random.rand() > 0.5:
-                pytest.skip('skipped in mexicoA')
+    _skip_unless_sampled(request, 10)  # skip 90% of tests
 
     print("\n\n")
     print("===x==="*10)
 
     mpi_conf, params = modified_config(gamma_conf, 0, 'mpi_conf.conf')
-
-    run(f"mpirun -n 3 pyrate conv2tif -f {mpi_conf}", shell=True, check=True)
-    run(f"mpirun -n 3 pyrate prepifg -f {mpi_conf}", shell=True, check=True)
-    try:
-        run(f"mpirun -n 3 pyrate correct -f {mpi_conf}", shell=True, check=True)
-        run(f"mpirun -n 3 pyrate timeseries -f {mpi_conf}", shell=True, check=True)
-        run(f"mpirun -n 3 pyrate stack -f {mpi_conf}", shell=True, check=True)
-        run(f"mpirun -n 3 pyrate merge -f {mpi_conf}", shell=True, check=True)
-    except CalledProcessError as e:
-        print(e)
-        pytest.skip("Skipping as part of correction error")
-
-    mr_conf, params_m = modified_config(gamma_conf, 1, 'multiprocess_conf.conf')
-
-    run(f"pyrate workflow -f {mr_conf}", shell=True, check=True)
-
+    # 2 processes, as the multiprocess pipeline shares the cpus with the other two pipelines
+    mr_conf, params_m = modified_config(gamma_conf, 1, 'multiprocess_conf.conf', processes=2)
     sr_conf, params_s = modified_config(gamma_conf, 0, 'singleprocess_conf.conf')
 
-    run(f"pyrate workflow -f {sr_conf}", shell=True, check=True)
+    # the three pipelines write to separate directories, so they can run at the same time
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        mpi_run = executor.submit(_run_mpi_pipeline, mpi_conf)
+        mr_run = executor.submit(_run_pipeline, mr_conf)
+        sr_run = executor.submit(_run_pipeline, sr_conf)
+    mr_run.result()
+    sr_run.result()
+    if not mpi_run.result():
+        pytest.skip("Skipping as part of correction error")
+    outputs = DirIndex()  # each output directory is listed once for all the checks below
 
     # convert2tif tests, 17 interferograms
     if not gamma_conf == MEXICO_CROPA_CONF:
-        assert_same_files_produced(params[C.INTERFEROGRAM_DIR],
-                                   params_m[C.INTERFEROGRAM_DIR], params_s[C.INTERFEROGRAM_DIR], "*_unw.tif", 17)
+        assert_same_files_produced(params[C.INTERFEROGRAM_DIR], params_m[C.INTERFEROGRAM_DIR],
+                                   params_s[C.INTERFEROGRAM_DIR], "*_unw.tif", 17, index=outputs)
         # dem
         assert_same_files_produced(params[C.GEOMETRY_DIR],
-                                   params_m[C.GEOMETRY_DIR], params_s[C.GEOMETRY_DIR], "*_dem.tif", 1)
+                                   params_m[C.GEOMETRY_DIR], params_s[C.GEOMETRY_DIR], "*_dem.tif", 1, index=outputs)
         # if coherence masking, comprare coh files were converted
         if params[C.COH_FILE_LIST] is not None:
             assert_same_files_produced(params[C.COHERENCE_DIR], params_m[C.COHERENCE_DIR], params_s[C.COHERENCE_DIR],
-                                       "*_cc.tif", 17)
+                                       "*_cc.tif", 17, index=outputs)
             print("coherence files compared")
 
     # prepifg checks
@@ -147,127 +185,155 @@ def test_pipeline_parallel_vs_mpi(modified_config, gamma_or_mexicoa_conf=TEST_CO
         assert_same_files_produced(
             params[C.GEOMETRY_DIR], params_m[C.GEOMETRY_DIR], params_s[C.GEOMETRY_DIR],
             [ft + '.tif' for ft in C.GEOMETRY_OUTPUT_TYPES] + ['*dem.tif'],
-            7 if gamma_conf == MEXICO_CROPA_CONF else 8
+            7 if gamma_conf == MEXICO_CROPA_CONF else 8, index=outputs
         )
 
     # ifgs
     assert_same_files_produced(params[C.INTERFEROGRAM_DIR], params_m[C.INTERFEROGRAM_DIR],
-                               params_s[C.INTERFEROGRAM_DIR], ["*_ifg.tif"], num_of_ifgs)
+                               params_s[C.INTERFEROGRAM_DIR], ["*_ifg.tif"], num_of_ifgs, index=outputs)
 
     # coherence
     assert_same_files_produced(params[C.COHERENCE_DIR], params_m[C.COHERENCE_DIR],
-                               params_s[C.COHERENCE_DIR], ["*_coh.tif"], num_of_coh)
+                               params_s[C.COHERENCE_DIR], ["*_coh.tif"], num_of_coh, index=outputs)
 
     # coherence stats
     assert_same_files_produced(params[C.COHERENCE_DIR], params_m[C.COHERENCE_DIR],
-                               params_s[C.COHERENCE_DIR], ["coh_*.tif"], 3)
+                               params_s[C.COHERENCE_DIR], ["coh_*.tif"], 3, index=outputs)
 
     num_files = 30 if gamma_conf == MEXICO_CROPA_CONF else 17
     # cf.TEMP_MLOOKED_DIR will contain the temp files that can be potentially deleted later
     assert_same_files_produced(params[C.TEMP_MLOOKED_DIR], params_m[C.TEMP_MLOOKED_DIR],
-                               params_s[C.TEMP_MLOOKED_DIR], "*_ifg.tif", num_files)
+                               params_s[C.TEMP_MLOOKED_DIR], "*_ifg.tif", num_files, index=outputs)
 
     # prepifg + correct steps that overwrite tifs test
     # ifg phase checking in the previous step checks the correct pipeline upto APS correction
+    tmp, tmp_m, tmp_s = (p[C.TMPDIR] for p in (params, params_m, params_s))
+    vel, vel_m, vel_s = (p[C.VELOCITY_DIR] for p in (params, params_m, params_s))
 
     # 2 x because of aps files
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "tsincr_*.npy", params['notiles'] * 2)
-
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "tscuml_*.npy", params['notiles'])
-
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "linear_rate_*.npy", params['notiles'])
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "linear_error_*.npy", params['notiles'])
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "linear_intercept_*.npy", params['notiles'])
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "linear_rsquared_*.npy", params['notiles'])
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "linear_samples_*.npy", params['notiles'])
-
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "stack_rate_*.npy", params['notiles'])
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "stack_error_*.npy", params['notiles'])
-    assert_same_files_produced(params[C.TMPDIR], params_m[C.TMPDIR], params_s[
-        C.TMPDIR], "stack_samples_*.npy", params['notiles'])
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "tsincr_*.npy", params['notiles'] * 2, index=outputs)
+
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "tscuml_*.npy", params['notiles'], index=outputs)
+
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "linear_rate_*.npy", params['notiles'], index=outputs)
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "linear_error_*.npy", params['notiles'], index=outputs)
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "linear_intercept_*.npy", params['notiles'], index=outputs)
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "linear_rsquared_*.npy", params['notiles'], index=outputs)
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "linear_samples_*.npy", params['notiles'], index=outputs)
+
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "stack_rate_*.npy", params['notiles'], index=outputs)
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "stack_error_*.npy", params['notiles'], index=outputs)
+    assert_same_files_produced(tmp, tmp_m, tmp_s, "stack_samples_*.npy", params['notiles'], index=outputs)
 
     # compare merge step
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "stack*.tif", 3)
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "stack*.kml", 2)
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "stack*.png", 2)
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "stack*.npy", 3)
+    assert_same_files_produced(vel, vel_m, vel_s, "stack*.tif", 3, index=outputs)
+    assert_same_files_produced(vel, vel_m, vel_s, "stack*.kml", 2, index=outputs)
+    assert_same_files_produced(vel, vel_m, vel_s, "stack*.png", 2, index=outputs)
+    assert_same_files_produced(vel, vel_m, vel_s, "stack*.npy", 3, index=outputs)
     
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "linear_*.tif", 5)
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "linear_*.kml", 3)
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "linear_*.png", 3)
-    assert_same_files_produced(params[C.VELOCITY_DIR], params_m[C.VELOCITY_DIR], params_s[
-        C.VELOCITY_DIR], "linear_*.npy", 5)
+    assert_same_files_produced(vel, vel_m, vel_s, "linear_*.tif", 5, index=outputs)
+    assert_same_files_produced(vel, vel_m, vel_s, "linear_*.kml", 3, index=outputs)
+    assert_same_files_produced(vel, vel_m, vel_s, "linear_*.png", 3, index=outputs)
+    assert_same_files_produced(vel, vel_m, vel_s, "linear_*.npy", 5, index=outputs)
 
     if params[C.PHASE_CLOSURE]:  # only in cropA
-        __check_equality_of_phase_closure_outputs(mpi_conf, sr_conf)
-        __check_equality_of_phase_closure_outputs(mpi_conf, mr_conf)
+        m_config = Configuration(mpi_conf)  # parsed once for both comparisons
+        __check_equality_of_phase_closure_outputs(m_config, sr_conf)
+        __check_equality_of_phase_closure_outputs(m_config, mr_conf)
         assert_same_files_produced(params[C.TIMESERIES_DIR], params_m[C.TIMESERIES_DIR], params_s[
-            C.TIMESERIES_DIR], "tscuml*.tif", 11)  # phase closure removes one tif
+            C.TIMESERIES_DIR], "tscuml*.tif", 11, index=outputs)  # phase closure removes one tif
         assert_same_files_produced(params[C.TIMESERIES_DIR], params_m[C.TIMESERIES_DIR], params_s[
-            C.TIMESERIES_DIR], "tsincr*.tif", 11)
+            C.TIMESERIES_DIR], "tsincr*.tif", 11, index=outputs)
     else:
         assert_same_files_produced(params[C.TIMESERIES_DIR], params_m[C.TIMESERIES_DIR], params_s[
-            C.TIMESERIES_DIR], "tscuml*.tif", 12)
+            C.TIMESERIES_DIR], "tscuml*.tif", 12, index=outputs)
         assert_same_files_produced(params[C.TIMESERIES_DIR], params_m[C.TIMESERIES_DIR], params_s[
-            C.TIMESERIES_DIR], "tsincr*.tif", 12)
+            C.TIMESERIES_DIR], "tsincr*.tif", 12, index=outputs)
         
     print("==========================xxx===========================")
 
-    shutil.rmtree(params[WORKING_DIR])
-    shutil.rmtree(params_m[WORKING_DIR])
-    shutil.rmtree(params_s[WORKING_DIR])
+    for p in (params, params_m, params_s):
+        deferred_rmtree(p[WORKING_DIR])
+
+
+# one thread per process, as the pipelines already run several processes side by side.
+# GDAL block and file caches let the steps of a batched workflow job reuse the rasters read by earlier steps.
+_PIPELINE_ENV = {
+    **os.environ,
+    "OMP_NUM_THREADS": "1",
+    "GDAL_CACHEMAX": "512",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(256 * 2 ** 20),
+}
+if RAM_TEMPDIR is not None:  # temp files of the pipelines also go to tmpfs
+    _PIPELINE_ENV["TMPDIR"] = RAM_TEMPDIR
 
+# commands are run without a shell, saving a fork/exec of /bin/sh per pipeline job
+_MPIRUN = ["mpirun", "-n", "3"]
 
-def __check_equality_of_phase_closure_outputs(mpi_conf, sr_conf):
-    m_config = Configuration(mpi_conf)
+
+def _run_mpi_pipeline(mpi_conf):
+    """Run the pipeline with MPI, returns False if a step from correct onwards failed"""
+    # batch the steps so that mpirun, interpreter start-up and imports are paid once per batch, not once per step
+    run(_MPIRUN + ["pyrate", "workflow", "-f", str(mpi_conf), "--stages", "conv2tif", "prepifg"], check=True,
+        env=_PIPELINE_ENV)
+    try:
+        run(_MPIRUN + ["pyrate", "workflow", "-f", str(mpi_conf), "--stages", "correct", "timeseries", "stack",
+                       "merge"], check=True, env=_PIPELINE_ENV)
+    except CalledProcessError as e:
+        print(e)
+        return False
+    return True
+
+
+def _run_pipeline(conf):
+    run(["pyrate", "workflow", "-f", str(conf)], check=True, env=_PIPELINE_ENV)
+
+
+def _loops_edge_keys(loops):
+    """Edges of all loops, flattened into one integer array of edge keys"""
+    return np.fromiter((edge_key(*e) for loop in loops for e in loop.edges), dtype=np.int64)
+
+
+def __check_equality_of_phase_closure_outputs(m_config, sr_conf):
     s_config = Configuration(sr_conf)
     m_close = m_config.closure()
     s_close = s_config.closure()
-    m_closure = np.load(m_close.closure)
-    s_closure = np.load(s_close.closure)
+    # byte identical outputs need not be loaded, otherwise the arrays are memory mapped for comparison
     # loops
-    m_loops = np.load(m_close.loops, allow_pickle=True)
-    s_loops = np.load(s_close.loops, allow_pickle=True)
-    m_weights = [m.weight for m in m_loops]
-    s_weights = [m.weight for m in s_loops]
-    np.testing.assert_array_equal(m_weights, s_weights)
-    for i, (m, s) in enumerate(zip(m_loops, s_loops)):
-        assert all(m_e == s_e for m_e, s_e in zip(m.edges, s.edges))
+    if not filecmp.cmp(m_close.loops, s_close.loops, shallow=False):
+        m_loops = np.load(m_close.loops, allow_pickle=True)
+        s_loops = np.load(s_close.loops, allow_pickle=True)
+        m_weights = np.fromiter((m.weight for m in m_loops), dtype=np.float64, count=len(m_loops))
+        s_weights = np.fromiter((s.weight for s in s_loops), dtype=np.float64, count=len(s_loops))
+        np.testing.assert_array_equal(m_weights, s_weights)
+        np.testing.assert_array_equal(_loops_edge_keys(m_loops), _loops_edge_keys(s_loops))
     # closure
-    np.testing.assert_array_almost_equal(np.abs(m_closure), np.abs(s_closure), decimal=4)
+    if not filecmp.cmp(m_close.closure, s_close.closure, shallow=False):
+        m_closure = np.load(m_close.closure, mmap_mode='r')
+        s_closure = np.load(s_close.closure, mmap_mode='r')
+        np.testing.assert_array_almost_equal(np.abs(m_closure), np.abs(s_closure), decimal=4)
     # num_occurrences_each_ifg
-    m_num_occurences_each_ifg = np.load(m_close.num_occurences_each_ifg, allow_pickle=True)
-    s_num_occurences_each_ifg = np.load(s_close.num_occurences_each_ifg, allow_pickle=True)
-    np.testing.assert_array_equal(m_num_occurences_each_ifg, s_num_occurences_each_ifg)
+    if not filecmp.cmp(m_close.num_occurences_each_ifg, s_close.num_occurences_each_ifg, shallow=False):
+        m_num_occurences_each_ifg = np.load(m_close.num_occurences_each_ifg, mmap_mode='r')
+        s_num_occurences_each_ifg = np.load(s_close.num_occurences_each_ifg, mmap_mode='r')
+        np.testing.assert_array_equal(m_num_occurences_each_ifg, s_num_occurences_each_ifg)
     # check ps
-    m_ifgs_breach_count = np.load(m_close.ifgs_breach_count)
-    s_ifgs_breach_count = np.load(s_close.ifgs_breach_count)
-    np.testing.assert_array_equal(m_ifgs_breach_count, s_ifgs_breach_count)
+    if not filecmp.cmp(m_close.ifgs_breach_count, s_close.ifgs_breach_count, shallow=False):
+        m_ifgs_breach_count = np.load(m_close.ifgs_breach_count, mmap_mode='r')
+        s_ifgs_breach_count = np.load(s_close.ifgs_breach_count, mmap_mode='r')
+        np.testing.assert_array_equal(m_ifgs_breach_count, s_ifgs_breach_count)
 
 
-@pytest.fixture(params=[0, 1])
+@pytest.fixture(params=[1, 0])
 def coh_mask(request):
+    """coherence masking (1) adds work to prepifg"""
     return request.param
 
 
 @pytest.fixture()
 def modified_config_short(tempdir, local_crop, get_lks, coh_mask):
+    parsed_confs = {}
     orbfit_lks = 1
     orbfit_method = 1
     orbfit_degrees = 1
@@ -276,7 +342,7 @@ def modified_config_short(tempdir, local_crop, get_lks, coh_mask):
 
     def modify_params(conf_file, parallel, output_conf_file, largetifs):
         tdir = Path(tempdir())
-        params = manipulate_test_conf(conf_file, tdir)
+        params = manipulate_test_conf(conf_file, tdir, _parsed_conf_copy(parsed_confs, conf_file))
         params[C.COH_MASK] = coh_mask
         params[C.PARALLEL] = parallel
         params[C.PROCESSES] = 4
@@ -314,17 +380,17 @@ def create_mpi_files():
 
         mpi_conf, params = modified_config_short(gamma_conf, 0, 'mpi_conf.conf', 1)
 
-        check_call(f"mpirun -n 3 pyrate conv2tif -f {mpi_conf}", shell=True)
-        check_call(f"mpirun -n 3 pyrate prepifg -f {mpi_conf}", shell=True)
+        # steps are batched into workflow jobs, only a failure from correct to stack skips the test
+        check_call(_MPIRUN + ["pyrate", "workflow", "-f", str(mpi_conf), "--stages", "conv2tif", "prepifg"],
+                   env=_PIPELINE_ENV)
 
         try:
-            check_call(f"mpirun -n 3 pyrate correct -f {mpi_conf}", shell=True)
-            check_call(f"mpirun -n 3 pyrate timeseries -f {mpi_conf}", shell=True)
-            check_call(f"mpirun -n 3 pyrate stack -f {mpi_conf}", shell=True)
+            check_call(_MPIRUN + ["pyrate", "workflow", "-f", str(mpi_conf), "--stages", "correct", "timeseries",
+                                  "stack"], env=_PIPELINE_ENV)
         except CalledProcessError as c:
             print(c)
             pytest.skip("Skipping as we encountered a process error during CI")
-        check_call(f"mpirun -n 3 pyrate merge -f {mpi_conf}", shell=True)
+        check_call(_MPIRUN + ["pyrate", "merge", "-f", str(mpi_conf)], env=_PIPELINE_ENV)
         return params
 
     return _create
@@ -333,7 +399,8 @@ def create_mpi_files():
 @pytest.mark.mpi
 @pytest.mark.slow
 @pytest.mark.skipif(not PY37GDAL304, reason="Only run in one CI env")
-def test_stack_and_ts_mpi_vs_parallel_vs_serial(modified_config_short, gamma_conf, create_mpi_files, parallel):
+def test_stack_and_ts_mpi_vs_parallel_vs_serial(request, modified_config_short, gamma_conf, create_mpi_files,
+                                                parallel, deferred_rmtree):
     """
     Checks performed:
     1. mpi vs single process pipeline
@@ -341,8 +408,7 @@ def test_stack_and_ts_mpi_vs_parallel_vs_serial(modified_config_short, gamma_con
     3. Doing 1 and 2 means we have checked single vs parallel python multiprocess pipelines
     4. This also checks the entire pipeline using largetifs (new prepifg) vs old perpifg (python based)
     """
-    if np.random.randint(0, 1000) > 300:  # skip 90% of tests randomly
-        pytest.skip("Randomly skipping as part of 60 percent")
+    _skip_unless_sampled(request, 30)  # skip 70% of tests
 
     print("\n\n")
 
@@ -352,55 +418,58 @@ def test_stack_and_ts_mpi_vs_parallel_vs_serial(modified_config_short, gamma_con
 
     sr_conf, params_p = modified_config_short(gamma_conf, parallel, 'parallel_conf.conf', 0)
 
-    check_call(f"pyrate workflow -f {sr_conf}", shell=True)
+    check_call(["pyrate", "workflow", "-f", str(sr_conf)], env=_PIPELINE_ENV)
+    outputs = DirIndex()  # each output directory is listed once for all the checks below
 
     # convert2tif tests, 17 interferograms
-    assert_two_dirs_equal(params[C.INTERFEROGRAM_DIR], params_p[C.INTERFEROGRAM_DIR], "*_unw.tif", 17)
+    assert_two_dirs_equal(params[C.INTERFEROGRAM_DIR], params_p[C.INTERFEROGRAM_DIR], "*_unw.tif", 17, index=outputs)
 
     # if coherence masking, compare coh files were converted
     if params[C.COH_FILE_LIST] is not None:
-        assert_two_dirs_equal(params[C.COHERENCE_DIR], params_p[C.COHERENCE_DIR], "*_cc.tif", 17)
+        assert_two_dirs_equal(params[C.COHERENCE_DIR], params_p[C.COHERENCE_DIR], "*_cc.tif", 17, index=outputs)
         print("coherence files compared")
-    assert_two_dirs_equal(params[C.INTERFEROGRAM_DIR], params_p[C.INTERFEROGRAM_DIR], ["*_ifg.tif"], 17)
+    assert_two_dirs_equal(params[C.INTERFEROGRAM_DIR], params_p[C.INTERFEROGRAM_DIR], ["*_ifg.tif"], 17, index=outputs)
 
     # one original dem, another multilooked dem
-    assert_two_dirs_equal(params[C.GEOMETRY_DIR], params_p[C.GEOMETRY_DIR], ['*dem.tif'], 2)
+    assert_two_dirs_equal(params[C.GEOMETRY_DIR], params_p[C.GEOMETRY_DIR], ['*dem.tif'], 2, index=outputs)
     assert_two_dirs_equal(params[C.GEOMETRY_DIR], params_p[C.GEOMETRY_DIR],
-                          [t + "*.tif" for t in C.GEOMETRY_OUTPUT_TYPES], 6)  # 2 dems, 6 geom
+                          [t + "*.tif" for t in C.GEOMETRY_OUTPUT_TYPES], 6, index=outputs)  # 2 dems, 6 geom
 
-    assert_two_dirs_equal(params[C.TEMP_MLOOKED_DIR], params_p[C.TEMP_MLOOKED_DIR], "*_ifg.tif", 17)
+    assert_two_dirs_equal(params[C.TEMP_MLOOKED_DIR], params_p[C.TEMP_MLOOKED_DIR], "*_ifg.tif", 17, index=outputs)
 
     # ifg phase checking in the previous step checks the correct pipeline upto APS correction
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "tsincr_*.npy", params['notiles'] * 2)
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "tscuml_*.npy", params['notiles'])
+    tmp, tmp_p = params[C.TMPDIR], params_p[C.TMPDIR]
+    vel, vel_p = params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR]
+    assert_two_dirs_equal(tmp, tmp_p, "tsincr_*.npy", params['notiles'] * 2, index=outputs)
+    assert_two_dirs_equal(tmp, tmp_p, "tscuml_*.npy", params['notiles'], index=outputs)
 
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "linear_rate_*.npy", params['notiles'])
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "linear_error_*.npy", params['notiles'])
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "linear_samples_*.npy", params['notiles'])
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "linear_intercept_*.npy", params['notiles'])
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "linear_rsquared_*.npy", params['notiles'])
+    assert_two_dirs_equal(tmp, tmp_p, "linear_rate_*.npy", params['notiles'], index=outputs)
+    assert_two_dirs_equal(tmp, tmp_p, "linear_error_*.npy", params['notiles'], index=outputs)
+    assert_two_dirs_equal(tmp, tmp_p, "linear_samples_*.npy", params['notiles'], index=outputs)
+    assert_two_dirs_equal(tmp, tmp_p, "linear_intercept_*.npy", params['notiles'], index=outputs)
+    assert_two_dirs_equal(tmp, tmp_p, "linear_rsquared_*.npy", params['notiles'], index=outputs)
 
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "stack_rate_*.npy", params['notiles'])
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "stack_error_*.npy", params['notiles'])
-    assert_two_dirs_equal(params[C.TMPDIR], params_p[C.TMPDIR], "stack_samples_*.npy", params['notiles'])
+    assert_two_dirs_equal(tmp, tmp_p, "stack_rate_*.npy", params['notiles'], index=outputs)
+    assert_two_dirs_equal(tmp, tmp_p, "stack_error_*.npy", params['notiles'], index=outputs)
+    assert_two_dirs_equal(tmp, tmp_p, "stack_samples_*.npy", params['notiles'], index=outputs)
 
     # compare merge step
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "stack*.tif", 3)
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "stack*.kml", 2)
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "stack*.png", 2)
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "stack*.npy", 3)
+    assert_two_dirs_equal(vel, vel_p, "stack*.tif", 3, index=outputs)
+    assert_two_dirs_equal(vel, vel_p, "stack*.kml", 2, index=outputs)
+    assert_two_dirs_equal(vel, vel_p, "stack*.png", 2, index=outputs)
+    assert_two_dirs_equal(vel, vel_p, "stack*.npy", 3, index=outputs)
 
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "linear*.tif", 5)
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "linear*.kml", 3)
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "linear*.png", 3)
-    assert_two_dirs_equal(params[C.VELOCITY_DIR], params_p[C.VELOCITY_DIR], "linear*.npy", 5)
+    assert_two_dirs_equal(vel, vel_p, "linear*.tif", 5, index=outputs)
+    assert_two_dirs_equal(vel, vel_p, "linear*.kml", 3, index=outputs)
+    assert_two_dirs_equal(vel, vel_p, "linear*.png", 3, index=outputs)
+    assert_two_dirs_equal(vel, vel_p, "linear*.npy", 5, index=outputs)
 
-    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tscuml*.tif")
-    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tsincr*.tif")
-    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tscuml*.npy")
-    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tsincr*.npy")
+    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tscuml*.tif", index=outputs)
+    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tsincr*.tif", index=outputs)
+    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tscuml*.npy", index=outputs)
+    assert_two_dirs_equal(params[C.TIMESERIES_DIR], params_p[C.TIMESERIES_DIR], "tsincr*.npy", index=outputs)
 
     print("==========================xxx===========================")
 
-    shutil.rmtree(params[WORKING_DIR])
-    shutil.rmtree(params_p[WORKING_DIR])
+    for p in (params, params_p):
+        deferred_rmtree(p[WORKING_DIR])
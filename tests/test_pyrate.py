@@ -98,6 +98,42 @@ def test_dest_ifg_paths():
                                                            'ifg1.tif']]
 
 
+@pytest.fixture
+def run_workflow(monkeypatch):
+    """
+    Runs `pyrate workflow` with the stage mains replaced by stubs, and returns the stages run, in order.
+    """
+    def _run(*stages_args):
+        ran = []
+        monkeypatch.setattr(pyrate.main, '_params_from_conf', lambda config_file: {C.OUT_DIR: 'out'})
+        monkeypatch.setattr(pyrate.main, 'configure_stage_log', lambda *args: None)
+        monkeypatch.setattr(pyrate.main, 'Configuration', lambda config_file: None)
+        monkeypatch.setattr(pyrate.main.conv2tif, 'main', lambda params: ran.append('conv2tif'))
+        monkeypatch.setattr(pyrate.main.prepifg, 'main', lambda params: ran.append('prepifg'))
+        monkeypatch.setattr(pyrate.main.correct, 'main', lambda config: ran.append('correct'))
+        monkeypatch.setattr(pyrate.main, 'timeseries', lambda config: ran.append('timeseries'))
+        monkeypatch.setattr(pyrate.main, 'stack', lambda config: ran.append('stack'))
+        monkeypatch.setattr(pyrate.main.merge, 'main', lambda params: ran.append('merge'))
+        monkeypatch.setattr('sys.argv', ['pyrate', 'workflow', '-f', 'pyrate.conf', *stages_args])
+        pyrate.main.main()
+        return ran
+    return _run
+
+
+def test_workflow_runs_all_stages_by_default(run_workflow):
+    assert run_workflow() == pyrate.main.WORKFLOW_STAGES
+
+
+@pytest.mark.parametrize('stages, expected', [
+    (['correct'], ['correct']),
+    (['conv2tif', 'prepifg'], ['conv2tif', 'prepifg']),
+    (['merge', 'timeseries', 'correct'], ['correct', 'timeseries', 'merge']),
+    (['stack', 'prepifg', 'stack'], ['prepifg', 'stack']),
+])
+def test_workflow_runs_listed_stages_in_workflow_order(run_workflow, stages, expected):
+    assert run_workflow('--stages', *stages) == expected
+
+
 # FIXME: change to read output ifgs
 def get_ifgs(out_dir, _open=True):
     paths = glob.glob(join(out_dir, 'geo_*-*_unw.tif'))